@@ -68,6 +68,7 @@
               dependencies = final.lib.attrValues {
                 inherit (python.pkgs)
                   requests
+                  urllib3
                   ;
               };
             };
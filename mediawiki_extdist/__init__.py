@@ -17,21 +17,37 @@ VisualEditor extension (or the Vector skin if
 when debugging becomes less rare.
 """
 
-import glob
+import concurrent.futures
+import datetime
+import fcntl
+import importlib.metadata
 import json
 import logging
 import os
-import random
+import re
 import requests
+import requests.adapters
+import shlex
 import subprocess
 import sys
 import shutil
 import traceback
 import argparse
 import tempfile
+import threading
+from urllib3.util.retry import Retry
+
+try:
+    __version__ = importlib.metadata.version('mediawiki-extdist')
+except importlib.metadata.PackageNotFoundError:
+    # Running from a source checkout
+    __version__ = 'unknown'
 
 
 class TarballGenerator(object):
+    # Old-style tarball names, which included the short hash
+    OLD_TARBALL_RE = re.compile(r'^(?P<ext>.+)-(?P<branch>[^-]+)-[0-9a-f]{7}\.tar\.gz$')
+
     def __init__(self, conf, repo_type='extensions', force=False):
         self.API_URL = conf['API_URL']
         self.DIST_PATH = conf['DIST_PATH']
@@ -43,10 +59,32 @@ class TarballGenerator(object):
         self.REPO_TYPE = repo_type
         self.EXT_PATH = os.path.join(self.SRC_PATH, self.REPO_TYPE)
         self.COMPOSER = conf.get('COMPOSER')
+        # Shared by all extensions, so common dependencies are only downloaded once
+        self.COMPOSER_CACHE = conf.get(
+            'COMPOSER_CACHE', os.path.expanduser('~/.cache/mediawiki-extdist/composer'))
+        self.WORKERS = conf.get('WORKERS', 8)
+        # Compress tarballs on all cores if pigz is available
+        self.PIGZ = shutil.which('pigz')
         self._repo_list = None
         self._extension_config = None
+        # ext -> branch -> SHA-1 the last tarball was built from
+        self._manifest = {}
+        self._manifest_lock = threading.Lock()
+        # (ext, branch) -> old tarball filenames in DIST_PATH
+        self._dist_index = {}
+        self._dist_index_lock = threading.Lock()
+        self._pidfp = None
         self.force = force
         self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'mediawiki-extdist/%s' % __version__
+        # Keep connections to the API alive and retry transient server errors
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504]),
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     @property
     def repo_list(self):
@@ -114,29 +152,114 @@ class TarballGenerator(object):
         )
 
         # Check to make sure nightly.py isn't already running
-        if os.path.exists(self.PID_FILE):
-            with open(self.PID_FILE, 'r') as f:
-                old_pid = f.read()
+        self.lock_pid_file()
 
-            if self.check_pid(int(old_pid)):
-                logging.warning('Another process of nightly.py is still running, quitting this one')
-                quit()
+        # Init some directories we'll need
+        os.makedirs(self.EXT_PATH, exist_ok=True)
+        os.makedirs(self.DIST_PATH, exist_ok=True)
+        if self.COMPOSER:
+            os.makedirs(self.COMPOSER_CACHE, exist_ok=True)
 
-        self.create_pid_file()
+        self.load_manifest()
 
-        # Init some directories we'll need
-        if not os.path.isdir(self.EXT_PATH):
-            self.shell_exec(['mkdir', '-p', self.EXT_PATH])
-        if not os.path.isdir(self.DIST_PATH):
-            self.shell_exec(['mkdir', '-p', self.DIST_PATH])
+    @property
+    def manifest_file(self):
+        return os.path.join(self.DIST_PATH, '.extdist_manifest.json')
+
+    def load_manifest(self):
+        """
+        Loads the commits the existing tarballs were built from
+        """
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self._manifest = json.load(f)
+
+    def save_manifest(self):
+        """
+        Atomically writes the manifest back to DIST_PATH
+        """
+        tmp_file = self.manifest_file + '.tmp'
+        with self._manifest_lock:
+            with open(tmp_file, 'w') as f:
+                json.dump(self._manifest, f)
+            os.replace(tmp_file, self.manifest_file)
 
-    def shell_exec(self, args, **kwargs):
+    def index_dist(self):
+        """
+        Scans DIST_PATH once for old tarballs that need cleaning up
+        """
+        self._dist_index = {}
+        with os.scandir(self.DIST_PATH) as entries:
+            for entry in entries:
+                match = self.OLD_TARBALL_RE.match(entry.name)
+                if match:
+                    self._dist_index.setdefault((match['ext'], match['branch']), []).append(entry.name)
+
+    # Don't pass preexec_fn to the shell_* helpers, it forces
+    # subprocess to fall back from vfork() to a full fork()
+
+    def shell_run(self, args, **kwargs):
+        """
+        Shortcut wrapper to execute a shell command,
+        discarding its output
+
+        >>> self.shell_run(['git', 'fetch'])
+        """
+        subprocess.run(args, check=True, stdout=subprocess.DEVNULL, **kwargs)
+
+    def shell_read(self, args, **kwargs):
         """
         Shortcut wrapper to execute a shell command
+        and return its output
+
+        >>> self.shell_read(['ls', '-l'])
+        """
+        return subprocess.run(args, check=True, stdout=subprocess.PIPE, **kwargs).stdout.decode()
+
+    def shell_run_batch(self, commands, **kwargs):
+        """
+        Execute several commands in a single shell, stopping at the
+        first one that fails, discarding their output
+
+        >>> self.shell_run_batch([['git', 'fetch'], ['git', 'status']])
+        """
+        self.shell_run(' && '.join(shlex.join(command) for command in commands), shell=True, **kwargs)
+
+    def tar_gz(self, src_dir, out_path):
+        """
+        Create a gzipped tarball of src_dir (relative to EXT_PATH)
+        at the absolute out_path, leaving out the git metadata
+
+        >>> self.tar_gz('VisualEditor', '/srv/dist/VisualEditor-master.tar.gz')
+        """
+        try:
+            if self.PIGZ:
+                self._tar_pigz(src_dir, out_path)
+            else:
+                self.shell_run(['tar', '--exclude', '.git', '-czhPf', out_path, src_dir], cwd=self.EXT_PATH)
+        except BaseException:
+            # Don't leave half-written tarballs lying around
+            if os.path.exists(out_path):
+                os.unlink(out_path)
+            raise
 
-        >>> self.shell_exec(['ls', '-l'])
+    def _tar_pigz(self, src_dir, out_path):
         """
-        return subprocess.check_output(args, **kwargs).decode()
+        Pipe an uncompressed tar stream of src_dir into pigz
+        """
+        with open(out_path, 'wb') as f_out:
+            tar = subprocess.Popen(['tar', '--exclude', '.git', '-chPf', '-', src_dir],
+                                   cwd=self.EXT_PATH, stdout=subprocess.PIPE)
+            # Up to WORKERS of these run at once, share the cores between them
+            threads = max(1, (os.cpu_count() or 1) // self.WORKERS)
+            pigz = subprocess.Popen([self.PIGZ, '-n', '-p', str(threads)], stdin=tar.stdout, stdout=f_out)
+            # Only pigz should hold the read end of the pipe, so tar gets SIGPIPE if pigz dies
+            tar.stdout.close()
+            pigz.wait()
+            tar.wait()
+        for proc in (tar, pigz):
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
 
     def update_extension(self, ext, versions=None):
         """
@@ -146,133 +269,204 @@ class TarballGenerator(object):
         full_path = os.path.join(self.EXT_PATH, ext)
         logging.info('Starting update for %s' % ext)
         repo_url = self.GIT_URL % ext
+        branches = versions or self.supported_versions
+        if not self.force:
+            # Skip branches whose tarball was built from the current remote HEAD,
+            # asking the remote is much cheaper than fetching and checking out
+            remote_heads = {}
+            for line in self.shell_read(['git', 'ls-remote', '--heads', repo_url]).splitlines():
+                sha1, ref = line.split('\t')
+                remote_heads[ref[len('refs/heads/'):]] = sha1
+            with self._manifest_lock:
+                built = dict(self._manifest.get(ext, {}))
+            for branch in branches:
+                if branch not in remote_heads:
+                    # Just a warning because this is expected for some extensions
+                    logging.warning('origin/%s does not exist' % branch)
+            existing = [branch for branch in branches if branch in remote_heads]
+            if not existing:
+                logging.info('None of the requested branches exist for %s' % ext)
+                return
+            branches = [
+                branch for branch in existing
+                if not (built.get(branch) == remote_heads[branch]
+                        and os.path.exists(os.path.join(self.DIST_PATH, '%s-%s.tar.gz' % (ext, branch))))
+            ]
+            if not branches:
+                logging.info('No updates for %s' % ext)
+                return
         if not os.path.exists(full_path):
-            os.chdir(self.EXT_PATH)
             logging.debug('Cloning %s' % ext)
-            self.shell_exec(['git', 'clone', repo_url, ext])
+            # Only the tip of each branch is packaged, so the history isn't needed
+            self.shell_run(['git', 'clone', '--depth=1', '--no-single-branch', '--no-tags', repo_url, ext],
+                           cwd=self.EXT_PATH)
+        # Tags aren't needed, we only check out branches
+        fetch_cmd = ['git', 'fetch', '--no-tags', '--prune']
+        try:
+            self.shell_run(['git', 'rev-parse', '--verify', '--quiet', 'HEAD'], cwd=full_path)
+        except subprocess.CalledProcessError:
+            # Shallow fetches fail in clones of empty repositories
             pass
-        for branch in (versions or self.supported_versions):
-            os.chdir(full_path)
-            logging.info('Creating %s for %s' % (branch, ext))
+        else:
+            fetch_cmd.append('--depth=1')
+        # Update remotes once, all branches are checked out from them below
+        self.shell_run_batch([
             # In case GIT_URL has changed
-            self.shell_exec(['git', 'remote', 'set-url', 'origin', repo_url])
-            # Update remotes
-            self.shell_exec(['git', 'fetch'])
-            try:
+            ['git', 'remote', 'set-url', 'origin', repo_url],
+            fetch_cmd,
+        ], cwd=full_path)
+        for branch in branches:
+            logging.info('Creating %s for %s' % (branch, ext))
+            checkout_cmds = [
                 # Could fail if repo is empty
-                self.shell_exec(['git', 'reset', '--hard', 'origin/master'])
-                # Reset everything!
-                self.shell_exec(['git', 'clean', '-ffdx'])
-                # Checkout the branch
-                self.shell_exec(['git', 'checkout', 'origin/%s' % branch])
+                ['git', 'reset', '--hard', 'origin/master'],
+                # Checkout the branch, even if untracked files are in the way
+                ['git', 'checkout', '-f', 'origin/%s' % branch],
+                # Reset everything! This also removes submodules
+                # that don't exist on this branch.
+                ['git', 'clean', '-ffdx'],
+            ]
+            prepare_cmds = [
+                # Sync submodules in case their urls have changed
+                ['git', 'submodule', 'sync'],
+                # Update them, initializing new ones if needed
+                ['git', 'submodule', 'update', '--init'],
+            ]
+            try:
+                self.shell_run_batch(checkout_cmds + prepare_cmds, cwd=full_path)
             except subprocess.CalledProcessError:
-                # Just a warning because this is expected for some extensions
-                logging.warning('could not checkout origin/%s' % branch)
-                continue
-            # Reset everything, again.
-            self.shell_exec(['git', 'clean', '-ffd'])
-            # Sync submodules in case their urls have changed
-            self.shell_exec(['git', 'submodule', 'sync'])
-            # Update them, initializing new ones if needed
-            self.shell_exec(['git', 'submodule', 'update', '--init'])
-            # Gets short hash of HEAD
-            rev = self.shell_exec(['git', 'rev-parse', '--short=7', 'HEAD']).strip()
+                # Go through the steps one by one to find out which one failed
+                try:
+                    for cmd in checkout_cmds:
+                        self.shell_run(cmd, cwd=full_path)
+                except subprocess.CalledProcessError:
+                    # Just a warning because this is expected for some extensions
+                    logging.warning('could not checkout origin/%s' % branch)
+                    continue
+                for cmd in prepare_cmds:
+                    self.shell_run(cmd, cwd=full_path)
+            # Gets short hash, full hash, commit date and refnames of HEAD
+            rev, head_sha1, head_commit_date, head_refs = self.shell_read(
+                ['git', 'log', '-1', '--abbrev=7', '--format=%h%n%H%n%ct%n%D', 'HEAD'], cwd=full_path
+            ).removesuffix('\n').split('\n', 3)
             # filename rev must be exactly 7 characters to match MW extension. (T365416)
             tarball_fname = '%s-%s.tar.gz' % (ext, branch)
-            if not self.force and os.path.exists(os.path.join(self.DIST_PATH, tarball_fname)):
+            with self._manifest_lock:
+                built_sha1 = self._manifest.get(ext, {}).get(branch)
+            # Tarballs without a manifest entry are of unknown age, so they get rebuilt once
+            if (not self.force and built_sha1 == head_sha1
+                    and os.path.exists(os.path.join(self.DIST_PATH, tarball_fname))):
                 logging.debug('No updates to branch, tarball already exists.')
                 continue
-            if self.COMPOSER and os.path.exists('composer.json'):
-                with open('composer.json') as f_composer:
-                    d_composer = json.load(f_composer)
-                if 'require' in d_composer:
+            composer_json = os.path.join(full_path, 'composer.json')
+            if self.COMPOSER and os.path.exists(composer_json):
+                with open(composer_json, 'rb') as f_composer:
+                    raw_composer = f_composer.read()
+                # No need to parse the whole file, at worst composer has nothing to install
+                if b'"require"' in raw_composer:
                     logging.debug('Running composer install for %s' % ext)
                     try:
-                        self.shell_exec([self.COMPOSER, 'install', '--no-dev', '--ignore-platform-reqs'])
+                        self.shell_run([self.COMPOSER, 'install', '--no-dev', '--ignore-platform-reqs',
+                                        '--prefer-dist', '--no-progress', '--no-interaction'],
+                                       cwd=full_path,
+                                       env={**os.environ, 'COMPOSER_CACHE_DIR': self.COMPOSER_CACHE})
                     except subprocess.CalledProcessError:
                         logging.error(traceback.format_exc())
                         logging.error('composer install failed')
             # Create gitinfo.json to be read/displayed by Special:Version
             git_info = {}
-            with open('.git/HEAD') as f_head:
-                head = f_head.read()
-            if head.startswith('ref:'):
-                head = head[5:]  # Strip 'ref :'
+            # HEAD is a symbolic ref if it shows up as 'HEAD -> <branch>',
+            # otherwise it is detached and we use the SHA-1 instead
+            head = head_sha1
+            for ref in head_refs.split(', '):
+                if ref.startswith('HEAD -> '):
+                    head = 'refs/heads/' + ref[len('HEAD -> '):]
             git_info['head'] = head
             # Get the SHA-1
-            git_info['headSHA1'] = self.shell_exec(['git', 'rev-parse', 'HEAD'])
-            git_info['headCommitDate'] = self.shell_exec(['git', 'show', '-s', '--format=format:%ct', 'HEAD'])
+            git_info['headSHA1'] = head_sha1
+            git_info['headCommitDate'] = head_commit_date
             if head.startswith('refs/heads'):
-                gi_branch = head.split('/')[-1]
+                gi_branch = head.rsplit('/', 1)[-1]
             else:
                 gi_branch = head
             git_info['branch'] = gi_branch
             git_info['remoteURL'] = self.GIT_URL % ext
-            with open('gitinfo.json', 'w') as f:
+            with open(os.path.join(full_path, 'gitinfo.json'), 'w') as f:
                 json.dump(git_info, f)
 
             # TODO: Stop writing this file now that we have gitinfo.json
             # Create a 'version' file with basic info about the tarball
-            with open('version', 'w') as f:
+            with open(os.path.join(full_path, 'version'), 'w') as f:
                 f.write('%s: %s\n' % (ext, branch))
-                f.write(self.shell_exec(['date', '+%Y-%m-%dT%H:%M:%S']) + '\n')  # TODO: Do this in python
+                f.write(datetime.datetime.now().isoformat(timespec='seconds') + '\n')
                 f.write(rev + '\n')
-            old_tarballs = glob.glob(os.path.join(self.DIST_PATH, '%s-%s-*.tar.gz' % (ext, branch)))
+            # Finally, create the new tarball directly in DIST_PATH
+            tarball_path = os.path.join(self.DIST_PATH, tarball_fname)
+            self.tar_gz(ext, tarball_path + '.tmp')
+            os.replace(tarball_path + '.tmp', tarball_path)
+            with self._manifest_lock:
+                self._manifest.setdefault(ext, {})[branch] = head_sha1
+            # Only now that the new one is in place
+            with self._dist_index_lock:
+                old_tarballs = self._dist_index.pop((ext, branch), [])
             logging.debug('Deleting old tarballs...')
             for old in old_tarballs:
-                # FIXME: Race condition, we should probably do this later on...
-                os.unlink(old)
-            os.chdir(self.EXT_PATH)
-            # Finally, create the new tarball
-            self.shell_exec(['tar', '--exclude', '.git', '-czhPf', tarball_fname, ext])
-        logging.debug('Moving new tarballs into dist/')
-        tarballs = glob.glob(os.path.join(self.EXT_PATH, '*.tar.gz'))
-        for tar in tarballs:
-            fname = tar.split('/')[-1]
-            shutil.move(tar, os.path.join(self.DIST_PATH, fname))
+                os.unlink(os.path.join(self.DIST_PATH, old))
         logging.info('Finished update for %s' % ext)
 
-        if random.randint(0, 99) == 0:
-            # Run git gc every 100th process (statistically)
-            self.shell_exec(['git', 'gc'], cwd=full_path)
+        # Only does something once git decides the repository needs repacking
+        self.shell_run(['git', 'gc', '--auto'], cwd=full_path)
 
-    def check_pid(self, pid):
+    def lock_pid_file(self):
         """
-        Checks whether the given pid is running
+        Takes an exclusive lock on the pid file and writes the current pid
+        to it, or quits if another process holds the lock. The lock is
+        released by the kernel when this process exits.
         """
+        # Don't truncate before we hold the lock, the pid in there might not be ours
+        self._pidfp = open(self.PID_FILE, 'a+')
         try:
-            # This doesn't actually kill it, just checks if it is running
-            os.kill(pid, 0)
-        except OSError:
-            # Not running
-            return False
-        else:
-            # So it must be running
-            return True
-
-    def create_pid_file(self):
-        """
-        Creates a pid file with the current pid
-        """
-        with open(self.PID_FILE, 'w') as f:
-            f.write(str(os.getpid()))
+            fcntl.flock(self._pidfp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.warning('Another process of nightly.py is still running, quitting this one')
+            sys.exit(0)
+        self._pidfp.truncate(0)
+        self._pidfp.write(str(os.getpid()))
+        self._pidfp.flush()
         logging.info('Creating pid file')
 
     def run(self, repos=None, versions=None):
         self.init()
-        if not repos:
-            repos = self.repo_list
+        self.index_dist()
+        # Populate the lazy-loaded API data in parallel before workers start,
+        # so they don't all hit the API at once
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            repos_future = executor.submit(lambda: repos or self.repo_list)
+            versions_future = executor.submit(lambda: versions or self.supported_versions)
+        repos = repos_future.result()
+        versions = versions_future.result()
         logging.info('Processing %s %s' % (len(repos), self.REPO_TYPE))
         logging.info('Starting update of all %s...' % self.REPO_TYPE)
-        for repo in repos:
-            try:
-                self.update_extension(repo, versions=versions)
-            except KeyboardInterrupt:
-                logging.error(traceback.format_exc())
-                sys.exit(1)
-            except Exception:
-                logging.error(traceback.format_exc())
-                logging.error('Updating %s failed, skipping' % repo)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.WORKERS) as executor:
+                futures = {
+                    executor.submit(self.update_extension, repo, versions=versions): repo
+                    for repo in repos
+                }
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        try:
+                            future.result()
+                        except Exception:
+                            logging.error(traceback.format_exc())
+                            logging.error('Updating %s failed, skipping' % futures[future])
+                except KeyboardInterrupt:
+                    logging.error(traceback.format_exc())
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    sys.exit(1)
+        finally:
+            # Keep what was built so far, even if we were interrupted
+            self.save_manifest()
         logging.info('Finished update of all %s!' % self.REPO_TYPE)
 
 